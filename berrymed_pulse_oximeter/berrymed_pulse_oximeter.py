@@ -1,25 +1,34 @@
 import Adafruit_BluefruitLE
 import logging
+import queue
 import signal
+import threading
 import time
-import itertools
 import binascii
+from array import array
 
-from collections import namedtuple
+from collections import deque, namedtuple
+from logging.handlers import QueueHandler, QueueListener
 from Adafruit_BluefruitLE.services import UART, DeviceInformation
 from Adafruit_BluefruitLE import platform
 from uuid import UUID
-from construct import BitStruct, BitsInteger, Flag, Bit, ConstructError
-from datetime import datetime
+from construct import BitStruct, BitsInteger, Flag, Bit
 
 
 DATA_SERVICE_UUID = UUID('49535343-fe7d-4ae5-8fa9-9fafd205e455')
 RECEIVE_CHARACTERISTIC = UUID('49535343-1E4D-4BD9-BA61-23C647249616')
 RENAME_CHARACTERISTIC_UUID = UUID('00005343-0000-1000-8000-00805F9B34FB')
-DATA_READ_TIMEOUT_MS = 20
+# How long to wait for a notification before checking whether reading should stop.
+NOTIFICATION_TIMEOUT_MS = 500
+SAMPLE_PERIOD_NS = 10 ** 9 // 60
+# Broken packets are counted and reported at most once per this interval.
+DISCARDED_PACKETS_REPORT_INTERVAL_NS = 10 * 10 ** 9
+# Log records waiting to be written to the file, logging blocks once the writer falls this far behind.
+LOG_QUEUE_SIZE = 1024
 
 # Bit number to its structure
 # This is the schema of the actual protocol, but we actually don't need all that stuff.
+# Packets are decoded with the equivalent bit masks from PACKET_FIELD_DECODERS, it's kept here for reference.
 PARSING_SCHEMA = {
     0: BitStruct(sync_bit=Flag, pulse_beep=Flag, probe_unplugged=Flag, has_signal=Flag, signal_strength=BitsInteger(4)),
     1: BitStruct(sync_bit=Flag, pleth=BitsInteger(7)),
@@ -28,64 +37,83 @@ PARSING_SCHEMA = {
     4: BitStruct(sync_bit=Flag, spo2=BitsInteger(7))
 }
 
+PACKET_LENGTH = 5
+# Sync bit (MSB) of every possible byte value, marks the first byte of a packet.
+SYNC_LUT = bytes((b >> 7) & 1 for b in range(256))
+# Sync bits of a well-formed packet, only its first byte has one.
+VALID_PACKET_SYNC_BITS = bytes([1] + [0] * (PACKET_LENGTH - 1))
+
 HeartRateData = namedtuple('HeartRateData', ['signal_strength', 'has_signal', 'pleth', 'bargraph', 'no_finger',
-                                             'pulse_rate', 'spo2', 'timestamp'])
+                                             'pulse_rate', 'spo2', 'timestamp_ns'])
+# Same fields as HeartRateData, each holding an array of values for all samples of one BLE read.
+HeartRateBatch = namedtuple('HeartRateBatch', HeartRateData._fields)
 
-# TODO: add logging configuration
-config_args = {
-    'level': logging.INFO,
-    'format': '[%(asctime)s] %(levelname).1s %(message)s',
-    'datefmt': '%Y.%m.%d %H:%M:%S',
-    'filename': '/tmp/bt_debug.log'
+# HeartRateData field to the expression decoding it from packet bytes b0..b4.
+PACKET_FIELD_DECODERS = {
+    'signal_strength': 'b0 & 0x0F',
+    'has_signal': '(b0 >> 4) & 1',
+    'pleth': 'b1',
+    'bargraph': 'b2 & 0x0F',
+    'no_finger': '(b2 >> 4) & 1',
+    'pulse_rate': 'b3 | ((b2 & 0x40) << 1)',
+    'spo2': 'b4',
 }
-logging.basicConfig(**config_args)
+PACKET_FIELDS = HeartRateData._fields[:-1]
 
 
-def starting_bit_lookup_condition(x):
-    try:
-        return PARSING_SCHEMA[0].parse(x.to_bytes(1, 'big')).sync_bit
-    except ConstructError:
-        return False
+def _compile_packet_decoder():
+    """Generates a function decoding packet bytes to a tuple of PACKET_FIELDS values, with all masks inlined."""
+    source = 'def decode(b0, b1, b2, b3, b4):\n    return ({},)\n'.format(
+        ', '.join(PACKET_FIELD_DECODERS[field] for field in PACKET_FIELDS))
+    namespace = {}
+    exec(source, namespace)
+    return namespace['decode']
+
 
+_decode_packet = _compile_packet_decoder()
 
-def chunks(iterable, condition):
-    """Yields split chunks for iterable containing sequences based on a passed condition for a head element.
 
-    e.g.:
-    [2, 1, 3, 2, 1, 3, 2, 1, 3] split over (lambda x: x == 3) ===> [2, 1], [3, 2, 1], [3, 2, 1], [3]
-    [3, 2, 1, 3, 2] split over (lambda x: x == 3) ===> [3, 2, 1], [3, 2]
-    [3, 2] split over (lambda x: x == 3) ===> [3, 2]
-    [2, 1] split over (lambda x: x == 3) ===> [2, 1]
+def parse_stream(data):
+    """Decodes all well-formed packets found in data.
 
-    :param iterable: any iterable
-    :param condition: callable with 1 argument returning boolean
-    :return: generator yielding tuples of sequence parts
+    Bytes are mapped to their sync bits with SYNC_LUT and packets are validated in bulk by searching the sync bits for
+    VALID_PACKET_SYNC_BITS, so the scan itself runs in C. A packet is well-formed if it's exactly PACKET_LENGTH bytes
+    long, everything else is discarded as broken, except for a trailing packet that may still be incomplete: it's left
+    unconsumed so that it can be parsed once the rest of it arrives.
+
+    :param data: bytes or bytearray
+    :return: tuple of unsigned char arrays, one per HeartRateData field except timestamp_ns,
+             number of bytes consumed and number of broken packets discarded
     """
-    it1, it2 = itertools.tee(iter(iterable))
-    sequence_started = False
-    while True:
-        sequence_ended = False
-        split_index = 1 if sequence_started else 0
-        try:
-            while not sequence_ended:
-                item = next(it2)
-                condition_result = condition(item)
-                if condition_result and split_index == 0:
-                    sequence_started = True
-                elif condition_result and split_index != 0:
-                    sequence_ended = True
-                    break
-                split_index += 1
-        except StopIteration:
-            pass
-
-        if split_index and sequence_ended:
-            sequence_started = True
-            # got the sequence tail, going on the next iteration anyway
-        chunk = bytearray(itertools.islice(it1, split_index))
-        if not chunk:
-            return
-        yield chunk
+    packets = []
+    view = memoryview(data)
+    sync_bits = data.translate(SYNC_LUT)
+    consumed = len(data)
+    last_sync = sync_bits.rfind(1)
+    if last_sync != -1 and consumed - last_sync < PACKET_LENGTH:
+        consumed = last_sync
+    packet_start = sync_bits.find(VALID_PACKET_SYNC_BITS, 0, consumed)
+    while packet_start != -1:
+        packet_end = packet_start + PACKET_LENGTH
+        # The packet is followed by another one or is the last one, otherwise it's too long.
+        if packet_end == consumed or sync_bits[packet_end]:
+            packets.append(_decode_packet(*view[packet_start:packet_end]))
+        packet_start = sync_bits.find(VALID_PACKET_SYNC_BITS, packet_end, consumed)
+    # Every sync bit not starting a decoded packet starts a broken one, bytes before the first sync bit are one more.
+    discarded = sync_bits.count(1, 0, consumed) - len(packets)
+    if consumed and not sync_bits[0]:
+        discarded += 1
+    columns = zip(*packets) if packets else ((),) * len(PACKET_FIELDS)
+    return tuple(array('B', column) for column in columns), consumed, discarded
+
+
+def iter_samples(batch):
+    """Yields HeartRateData for every sample of a HeartRateBatch.
+
+    :param batch: HeartRateBatch
+    :return: iterator over HeartRateData
+    """
+    return map(HeartRateData._make, zip(*batch))
 
 
 class BluetoothPulseSensorReader(object):
@@ -97,6 +125,21 @@ class BluetoothPulseSensorReader(object):
         self.ble_provider = ble_provider
         self._keep_reading = True
         self._device = None
+        self._notifications = deque()
+        # Received bytes not parsed yet, packets may be split between notifications.
+        self._buffer = bytearray()
+        self._discarded_packets = 0
+        self._discarded_packets_reported_ns = time.monotonic_ns()
+        self._last_timestamp_ns = None
+        self._notification_received = threading.Event()
+
+    def _on_notification(self, data):
+        # Called from the BLE provider thread.
+        # The BlueZ backend passes the value as a str with one char per byte, CoreBluetooth passes bytes.
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+        self._notifications.append(data)
+        self._notification_received.set()
 
     def _signal_handler(self, _, unused_frame):
         logging.info('Terminating heartrate reader.')
@@ -144,48 +187,107 @@ class BluetoothPulseSensorReader(object):
     def start_reading(self):
         try:
             self.ble_provider.clear_cached_data()
-            self._connect(ble_provider.get_default_adapter())
+            self._connect(self.ble_provider.get_default_adapter())
             pulse_characteristic = self._find_pulse_data_characteristic()
-            pulse_characteristic.start_notify(lambda x: None)
+            pulse_characteristic.start_notify(self._on_notification)
             logging.info('Subscribing to heartbeat data...')
             while self._keep_reading:
-                raw_data = bytearray(pulse_characteristic.read_value())
+                if not self._notification_received.wait(NOTIFICATION_TIMEOUT_MS / 1000):
+                    continue
+                self._notification_received.clear()
+                if not self._buffer and len(self._notifications) == 1:
+                    # Nothing is left over from previous notifications, so the data is parsed as is
+                    # and only its unconsumed tail gets copied to the buffer.
+                    raw_data = self._notifications.popleft()
+                else:
+                    while self._notifications:
+                        self._buffer.extend(self._notifications.popleft())
+                    raw_data = self._buffer
                 if not raw_data:
                     continue
 
-                for packet in chunks(raw_data, starting_bit_lookup_condition):
-                    if len(packet) != len(PARSING_SCHEMA):
-                        # discarding broken packet
-                        continue
-                    packet_dict = {}
+                now = time.monotonic_ns()
+                fields, consumed, discarded = parse_stream(raw_data)
+                if raw_data is self._buffer:
+                    del self._buffer[:consumed]
+                else:
+                    self._buffer.extend(memoryview(raw_data)[consumed:])
+                self._discarded_packets += discarded
+                if self._discarded_packets and \
+                        now - self._discarded_packets_reported_ns >= DISCARDED_PACKETS_REPORT_INTERVAL_NS:
+                    logging.warning('Discarded %d broken packets.', self._discarded_packets)
+                    self._discarded_packets = 0
+                    self._discarded_packets_reported_ns = now
+                samples_count = len(fields[0])
+                if samples_count:
+                    # Samples arrive at a fixed rate, the last one of the read is the most recent,
+                    # but a batch never starts before the end of the previous one.
+                    first_timestamp_ns = now - (samples_count - 1) * SAMPLE_PERIOD_NS
+                    if self._last_timestamp_ns is not None:
+                        first_timestamp_ns = max(first_timestamp_ns, self._last_timestamp_ns + SAMPLE_PERIOD_NS)
+                    timestamps = array('q', range(first_timestamp_ns,
+                                                  first_timestamp_ns + samples_count * SAMPLE_PERIOD_NS,
+                                                  SAMPLE_PERIOD_NS))
+                    self._last_timestamp_ns = timestamps[-1]
                     try:
-                        byte_1_data_container = PARSING_SCHEMA[0].parse(packet[0].to_bytes(1, 'big'))
-                        byte_3_data_container = PARSING_SCHEMA[2].parse(packet[2].to_bytes(1, 'big'))
-                        packet_dict['signal_strength'] = byte_1_data_container['signal_strength']
-                        packet_dict['has_signal'] = byte_1_data_container['has_signal']
-                        packet_dict['bargraph'] = byte_3_data_container['bargraph']
-                        packet_dict['no_finger'] = byte_3_data_container['no_finger']
-                        packet_dict['spo2'] = packet[4]
-                        packet_dict['pleth'] = packet[1]
-                        packet_dict['pulse_rate'] = packet[3] | ((packet[2] & 0x40) << 1)
-                        packet_dict['timestamp'] = str(datetime.now())
-                        self._handle_data_callback(HeartRateData(**packet_dict))
+                        self._handle_data_callback(HeartRateBatch(*fields, timestamps))
                     except Exception as e:
                         logging.exception(e)
-                        logging.debug('Error on parsing packet data: %s', e)
-                        continue
-
-                time.sleep(DATA_READ_TIMEOUT_MS/1000)
+                        logging.debug('Error on handling packet data: %s', e)
         finally:
+            if self._discarded_packets:
+                logging.warning('Discarded %d broken packets.', self._discarded_packets)
+                self._discarded_packets = 0
             if self._device:
                 self._device.disconnect()
 
 
-def handle_data(heart_rate):
-    logging.info(heart_rate)
+def handle_data(batch):
+    for heart_rate in iter_samples(batch):
+        logging.info(heart_rate)
+
+
+class BlockingQueueHandler(QueueHandler):
+    """QueueHandler waiting for free space in a bounded queue instead of failing on a full one."""
+
+    def enqueue(self, record):
+        self.queue.put(record)
+
+
+class BlockingQueueListener(QueueListener):
+    """QueueListener waiting for free space in a bounded queue to enqueue its stop sentinel."""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+# TODO: add logging configuration
+config_args = {
+    'level': logging.INFO,
+    'format': '[%(asctime)s] %(levelname).1s %(message)s',
+    'datefmt': '%Y.%m.%d %H:%M:%S',
+    'filename': '/tmp/bt_debug.log'
+}
+
+
+def main():
+    # Records are written to the file by a background listener thread, so that logging every sample doesn't block
+    # the reading loop on file I/O. Messages are still rendered by the logging thread when they're enqueued.
+    log_file_handler = logging.FileHandler(config_args['filename'])
+    log_file_handler.setFormatter(logging.Formatter(config_args['format'], config_args['datefmt']))
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    log_listener = BlockingQueueListener(log_queue, log_file_handler)
+    logging.getLogger().setLevel(config_args['level'])
+    logging.getLogger().addHandler(BlockingQueueHandler(log_queue))
+    log_listener.start()
+    try:
+        ble_provider = Adafruit_BluefruitLE.get_provider()
+        ble_provider.initialize()
+        reader = BluetoothPulseSensorReader(ble_provider, handle_data)
+        ble_provider.run_mainloop_with(reader.start_reading)
+    finally:
+        log_listener.stop()
 
 
-ble_provider = Adafruit_BluefruitLE.get_provider()
-ble_provider.initialize()
-reader = BluetoothPulseSensorReader(ble_provider, handle_data)
-ble_provider.run_mainloop_with(reader.start_reading)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import unittest
+
+from unittest import mock
+
+from berrymed_pulse_oximeter import berrymed_pulse_oximeter as oximeter
+from berrymed_pulse_oximeter.berrymed_pulse_oximeter import (BluetoothPulseSensorReader, DATA_SERVICE_UUID,
+                                                             RECEIVE_CHARACTERISTIC, SAMPLE_PERIOD_NS, iter_samples)
+
+# signal_strength=5, has_signal=1, pleth=50, bargraph=7, no_finger=0, pulse_rate=208, spo2=97
+PACKET = bytes([0x95, 0x32, 0x47, 0x50, 0x61])
+PACKET_VALUES = (5, 1, 50, 7, 0, 208, 97)
+# signal_strength=1, has_signal=0, pleth=1, bargraph=2, no_finger=1, pulse_rate=3, spo2=4
+OTHER_PACKET = bytes([0x81, 0x01, 0x12, 0x03, 0x04])
+OTHER_PACKET_VALUES = (1, 0, 1, 2, 1, 3, 4)
+
+MS = 10 ** 6
+
+
+class FakeCharacteristic(object):
+
+    def __init__(self):
+        self.uuid = RECEIVE_CHARACTERISTIC
+        self.on_change = None
+
+    def start_notify(self, on_change):
+        self.on_change = on_change
+
+
+class FakeService(object):
+
+    def __init__(self, characteristic):
+        self.uuid = DATA_SERVICE_UUID
+        self._characteristic = characteristic
+
+    def list_characteristics(self):
+        return [self._characteristic]
+
+
+class FakeDevice(object):
+
+    def __init__(self, characteristic):
+        self.id = 'fake'
+        self.connected = False
+        self._service = FakeService(characteristic)
+
+    def connect(self):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def list_services(self):
+        return [self._service]
+
+
+class FakeNotificationEvent(object):
+    """Replaces the reader's notification event to deliver scripted notifications on every wait.
+
+    Each step is a (monotonic time in ns, list of notification values) tuple, the values are delivered through the
+    characteristic callback as the BLE provider thread would do. Reading stops once the script is exhausted.
+    """
+
+    def __init__(self, reader, characteristic, clock, steps):
+        self._reader = reader
+        self._characteristic = characteristic
+        self._clock = clock
+        self._steps = list(steps)
+
+    def wait(self, timeout=None):
+        if not self._steps:
+            self._reader._keep_reading = False
+            return False
+        self._clock.now, values = self._steps.pop(0)
+        for value in values:
+            self._characteristic.on_change(value)
+        return True
+
+    def set(self):
+        pass
+
+    def clear(self):
+        pass
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def monotonic_ns(self):
+        return self.now
+
+
+class BluetoothPulseSensorReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.characteristic = FakeCharacteristic()
+        self.device = FakeDevice(self.characteristic)
+        self.clock = FakeClock()
+        self.provider = mock.Mock()
+        self.batches = []
+        platform_provider = mock.Mock()
+        platform_provider.find_device.return_value = self.device
+        for patcher in (mock.patch.object(oximeter, 'UART'),
+                        mock.patch.object(oximeter, 'DeviceInformation'),
+                        mock.patch.object(oximeter.platform, 'get_provider', return_value=platform_provider),
+                        mock.patch.object(oximeter.signal, 'signal'),
+                        mock.patch.object(oximeter.time, 'monotonic_ns', self.clock.monotonic_ns)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def read(self, steps, callback=None):
+        reader = BluetoothPulseSensorReader(self.provider, callback or self.batches.append)
+        reader._notification_received = FakeNotificationEvent(reader, self.characteristic, self.clock, steps)
+        reader.start_reading()
+        return reader
+
+    def samples(self):
+        return [tuple(sample)[:-1] for batch in self.batches for sample in iter_samples(batch)]
+
+    def test_bytes_notification(self):
+        self.read([(0, [PACKET + OTHER_PACKET])])
+        self.assertEqual(self.samples(), [PACKET_VALUES, OTHER_PACKET_VALUES])
+        self.assertFalse(self.device.connected)
+
+    def test_str_notification(self):
+        # The BlueZ backend passes values as str with one char per byte.
+        self.read([(0, [(PACKET + OTHER_PACKET).decode('latin-1')])])
+        self.assertEqual(self.samples(), [PACKET_VALUES, OTHER_PACKET_VALUES])
+
+    def test_packet_split_between_notifications(self):
+        reader = self.read([(0, [PACKET + OTHER_PACKET[:2]]),
+                            (MS, [OTHER_PACKET[2:] + PACKET[:1]])])
+        self.assertEqual(self.samples(), [PACKET_VALUES, OTHER_PACKET_VALUES])
+        self.assertEqual(len(self.batches), 2)
+        self.assertEqual(reader._buffer, bytearray(PACKET[:1]))
+
+    def test_several_queued_notifications(self):
+        reader = self.read([(0, [PACKET[:3], PACKET[3:] + OTHER_PACKET[:1], OTHER_PACKET[1:]])])
+        self.assertEqual(self.samples(), [PACKET_VALUES, OTHER_PACKET_VALUES])
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(reader._buffer, bytearray())
+
+    def test_timestamps_within_batch(self):
+        self.read([(100 * MS, [PACKET + OTHER_PACKET + PACKET])])
+        self.assertEqual(list(self.batches[0].timestamp_ns),
+                         [100 * MS - 2 * SAMPLE_PERIOD_NS, 100 * MS - SAMPLE_PERIOD_NS, 100 * MS])
+
+    def test_timestamps_increase_across_batches(self):
+        self.read([(100 * MS, [PACKET]),
+                   (101 * MS, [OTHER_PACKET + PACKET + OTHER_PACKET + PACKET])])
+        timestamps = [t for batch in self.batches for t in batch.timestamp_ns]
+        self.assertEqual(timestamps, [100 * MS + i * SAMPLE_PERIOD_NS for i in range(5)])
+
+    def test_timestamps_follow_clock_after_gap(self):
+        self.read([(100 * MS, [PACKET]), (5000 * MS, [OTHER_PACKET + PACKET])])
+        self.assertEqual(list(self.batches[1].timestamp_ns), [5000 * MS - SAMPLE_PERIOD_NS, 5000 * MS])
+
+    def test_discarded_packets_report_is_throttled(self):
+        with self.assertLogs(level='WARNING') as logs:
+            self.read([(1000 * MS, [PACKET[:3] + OTHER_PACKET]),
+                       (2000 * MS, [PACKET + b'\x01']),
+                       (11000 * MS, [OTHER_PACKET])])
+        self.assertEqual(logs.output, ['WARNING:root:Discarded 2 broken packets.'])
+        self.assertEqual(self.samples(), [OTHER_PACKET_VALUES, OTHER_PACKET_VALUES])
+
+    def test_discarded_packets_are_reported_on_stop(self):
+        with self.assertLogs(level='WARNING') as logs:
+            self.read([(1000 * MS, [PACKET[:3] + OTHER_PACKET])])
+        self.assertEqual(logs.output, ['WARNING:root:Discarded 1 broken packets.'])
+
+    def test_callback_error_does_not_stop_reading(self):
+        def callback(batch):
+            self.batches.append(batch)
+            raise ValueError('broken callback')
+
+        with self.assertLogs(level='ERROR'):
+            self.read([(0, [PACKET]), (MS, [OTHER_PACKET])], callback)
+        self.assertEqual(self.samples(), [PACKET_VALUES, OTHER_PACKET_VALUES])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+
+from array import array
+
+from berrymed_pulse_oximeter.berrymed_pulse_oximeter import (HeartRateBatch, HeartRateData, PACKET_FIELDS,
+                                                             iter_samples, parse_stream)
+
+# signal_strength=5, has_signal=1, pleth=50, bargraph=7, no_finger=0, pulse_rate=208, spo2=97
+PACKET = bytes([0x95, 0x32, 0x47, 0x50, 0x61])
+PACKET_VALUES = (5, 1, 50, 7, 0, 208, 97)
+# signal_strength=1, has_signal=0, pleth=1, bargraph=2, no_finger=1, pulse_rate=3, spo2=4
+OTHER_PACKET = bytes([0x81, 0x01, 0x12, 0x03, 0x04])
+OTHER_PACKET_VALUES = (1, 0, 1, 2, 1, 3, 4)
+
+
+def decoded(fields):
+    return list(zip(*fields))
+
+
+class ParseStreamTest(unittest.TestCase):
+
+    def test_empty_buffer(self):
+        fields, consumed, discarded = parse_stream(bytearray())
+        self.assertEqual(len(fields), len(PACKET_FIELDS))
+        self.assertEqual(decoded(fields), [])
+        self.assertEqual(consumed, 0)
+        self.assertEqual(discarded, 0)
+
+    def test_packets_are_decoded(self):
+        data = bytearray(PACKET + OTHER_PACKET)
+        fields, consumed, discarded = parse_stream(data)
+        self.assertEqual(decoded(fields), [PACKET_VALUES, OTHER_PACKET_VALUES])
+        self.assertTrue(all(isinstance(column, array) for column in fields))
+        self.assertEqual(consumed, len(data))
+        self.assertEqual(discarded, 0)
+
+    def test_leading_bytes_without_sync_bit_are_discarded(self):
+        data = bytearray(b'\x01\x02' + PACKET)
+        fields, consumed, discarded = parse_stream(data)
+        self.assertEqual(decoded(fields), [PACKET_VALUES])
+        self.assertEqual(consumed, len(data))
+        self.assertEqual(discarded, 1)
+
+    def test_only_bytes_without_sync_bit_are_discarded(self):
+        data = bytearray(b'\x01\x02\x03')
+        fields, consumed, discarded = parse_stream(data)
+        self.assertEqual(decoded(fields), [])
+        self.assertEqual(consumed, len(data))
+        self.assertEqual(discarded, 1)
+
+    def test_too_long_packet_is_discarded(self):
+        data = bytearray(PACKET + b'\x01' + OTHER_PACKET)
+        fields, consumed, discarded = parse_stream(data)
+        self.assertEqual(decoded(fields), [OTHER_PACKET_VALUES])
+        self.assertEqual(consumed, len(data))
+        self.assertEqual(discarded, 1)
+
+    def test_too_short_packet_is_discarded(self):
+        data = bytearray(PACKET[:3] + OTHER_PACKET)
+        fields, consumed, discarded = parse_stream(data)
+        self.assertEqual(decoded(fields), [OTHER_PACKET_VALUES])
+        self.assertEqual(consumed, len(data))
+        self.assertEqual(discarded, 1)
+
+    def test_trailing_partial_packet_is_left_unconsumed(self):
+        for length in range(1, len(PACKET)):
+            with self.subTest(length=length):
+                data = bytearray(PACKET + OTHER_PACKET[:length])
+                fields, consumed, discarded = parse_stream(data)
+                self.assertEqual(decoded(fields), [PACKET_VALUES])
+                self.assertEqual(consumed, len(PACKET))
+                self.assertEqual(discarded, 0)
+
+    def test_trailing_complete_packet_is_consumed(self):
+        data = bytearray(b'\x01' + PACKET)
+        fields, consumed, discarded = parse_stream(data)
+        self.assertEqual(decoded(fields), [PACKET_VALUES])
+        self.assertEqual(consumed, len(data))
+        self.assertEqual(discarded, 1)
+
+    def test_packet_split_between_calls(self):
+        data = bytearray(PACKET[:2])
+        fields, consumed, discarded = parse_stream(data)
+        self.assertEqual((decoded(fields), consumed, discarded), ([], 0, 0))
+        data += PACKET[2:]
+        fields, consumed, discarded = parse_stream(data)
+        self.assertEqual((decoded(fields), consumed, discarded), ([PACKET_VALUES], len(PACKET), 0))
+
+    def test_bytes_input(self):
+        fields, consumed, discarded = parse_stream(PACKET + OTHER_PACKET[:2])
+        self.assertEqual((decoded(fields), consumed, discarded), ([PACKET_VALUES], len(PACKET), 0))
+
+
+class IterSamplesTest(unittest.TestCase):
+
+    def test_yields_heart_rate_data_per_sample(self):
+        fields, _, _ = parse_stream(bytearray(PACKET + OTHER_PACKET))
+        batch = HeartRateBatch(*fields, array('q', [10, 20]))
+        self.assertEqual(list(iter_samples(batch)), [HeartRateData(*PACKET_VALUES, 10),
+                                                     HeartRateData(*OTHER_PACKET_VALUES, 20)])
+
+
+if __name__ == '__main__':
+    unittest.main()